@@ -1,5 +1,7 @@
 from .btsf import *
+from .checksum import *
 from .exceptions import *
 from .intro import *
 from .metric import *
+from .stats import *
 from .util import *
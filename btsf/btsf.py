@@ -1,10 +1,14 @@
+import contextlib
 import json
+import os
 import struct
 from typing import List
 
 from .exceptions import *
 from .intro import *
+from .checksum import BlockChecksums
 from .metric import *
+from .stats import CountingFile, IOStats
 
 __all__ = ["BinaryTimeSeriesFile"]
 
@@ -13,6 +17,9 @@ class BinaryTimeSeriesFile:
 
     FILE_SIGNATURE = b"BinaryTimeSeriesFile_v0.1\x00\x00\x00\x00\x00\x00\x00"
     HEADER_PADDING = 8
+    # payload of the CommittedLength intro section of preallocated files:
+    # number of committed entries, preallocation extent size in bytes
+    COMMITTED_LENGTH = struct.Struct("<QQ")
 
     _chunksize = 256
 
@@ -23,6 +30,23 @@ class BinaryTimeSeriesFile:
     def __init__(self, filename):
         self._fdname = filename
         self._fd = None
+        self._stats = None
+        # file offset of the CommittedLength payload (preallocated files only)
+        self._committed_offset = None
+        # number of entries as known to a writing instance of a preallocated file
+        self._n_written = None
+        # file offset of the end of the committed entries as last read by
+        # __next__ (preallocated files only, refreshed when reached)
+        self._committed_end = 0
+        # number of committed entries last seen by a reading instance
+        self._n_committed = None
+        # entries per checksummed block (0: file without checksums)
+        self._checksum_block = 0
+        self._checksums = None
+        # whether reading verifies the checksums of the touched blocks
+        self._verify = False
+        # entries covered by the checksums already verified, by block
+        self._verified = {}
 
     @classmethod
     def openwrite(cls, filename):
@@ -31,11 +55,17 @@ class BinaryTimeSeriesFile:
         return f
 
     @classmethod
-    def openread(cls, filename):
-        return cls._open(filename, mode="rb")
+    def openread(cls, filename, verify=False):
+        """
+        Open a file for reading.
+
+        verify: check the entries read against the block checksums of the
+                file (if it has any), raising ChecksumError on a mismatch.
+        """
+        return cls._open(filename, mode="rb", verify=verify)
 
     @classmethod
-    def _open(cls, filename, mode):
+    def _open(cls, filename, mode, verify=False):
         # pylint:disable=protected-access,attribute-defined-outside-init
         f = BinaryTimeSeriesFile(filename)
         f._fd = open(filename, mode)
@@ -46,6 +76,8 @@ class BinaryTimeSeriesFile:
         f._intro_sections = []
         ish = IntroSectionHeader.load_from(f._fd)
         while ish.type != IntroSectionType.EndOfIntro:
+            if ish.type == IntroSectionType.CommittedLength:
+                f._committed_offset = f._fd.tell()
             intro_section = IntroSection(header=ish, payload=f._fd.read(ish.payload_size))
             f._intro_sections.append(intro_section)
             # advance file pointer according to next intro section header
@@ -58,15 +90,36 @@ class BinaryTimeSeriesFile:
         master_intro = json.loads(f._intro_sections[0].payload.decode("utf-8"))
 
         # now interpret the master intro:
-        f._metrics = [Metric(**m) for m in master_intro["metrics"]]
-        for m in f._metrics:
-            m.type = MetricType(m.type)
+        f._metrics = [
+            Metric(**dict(m, type=MetricType(m["type"])))
+            for m in master_intro["metrics"]
+        ]
         f._struct_format = master_intro["struct_format"]
         f._struct = struct.Struct(f._struct_format)
         f._struct_size = master_intro["struct_size"]
         f._byte_order = master_intro["byte_order"]
         f._pad_to = master_intro["pad_to"]
         f._data_offset = f._fd.tell()
+        f._init_conversions()
+
+        if f._committed_offset is not None and mode != "rb":
+            committed = next(
+                s
+                for s in f._intro_sections
+                if s.header.type == IntroSectionType.CommittedLength
+            )
+            f._n_written, f._extent = cls.COMMITTED_LENGTH.unpack(committed.payload)
+            f._allocated = os.fstat(f._fd.fileno()).st_size
+
+        if "checksums" in master_intro:
+            f._checksum_block = master_intro["checksums"]["block_entries"]
+            if mode != "rb":
+                f._checksums = BlockChecksums.resume(
+                    filename, f._checksum_block, f._struct_size, f.n_entries, f._pread
+                )
+            elif verify:
+                f._checksums = BlockChecksums(filename, f._checksum_block, f._struct_size)
+                f._verify = True
 
         # round chunksize down to closest multiple of f._struct_size:
         # but f._struct_size is our minimum chunksize:
@@ -95,6 +148,25 @@ class BinaryTimeSeriesFile:
     def _struct_padding(self):
         return self._assemble_struct(self._byte_order, self._metrics, self._pad_to)[1]
 
+    def _init_conversions(self):
+        # indices of metrics whose stored values need to be encoded / decoded
+        # (scaled integers, bit flags); empty for plain files (fast path)
+        self._conversions = [
+            (i, m) for i, m in enumerate(self._metrics) if m.needs_conversion
+        ]
+
+    def _encode(self, values):
+        values = list(values)
+        for i, m in self._conversions:
+            values[i] = m.encode(values[i])
+        return values
+
+    def _decode(self, values):
+        values = list(values)
+        for i, m in self._conversions:
+            values[i] = m.decode(values[i])
+        return tuple(values)
+
     def seekend(self):
         self._fd.seek(0, 2)  # SEEK_END
 
@@ -111,7 +183,22 @@ class BinaryTimeSeriesFile:
         intro_sections: List[IntroSection] = None,
         byte_order: str = "<",
         pad_to: int = 8,
+        preallocate: int = 0,
+        checksum_block: int = 0,
     ):
+        """
+        Create a new file (overwriting an existing one).
+
+        preallocate: if > 0, the file is grown in extents of this many bytes
+                     (using os.posix_fallocate where available) instead of with
+                     every appended entry, keeping long-running files contiguous
+                     on disk. The number of committed entries is then kept in an
+                     intro section, updated by flush() and close(); readers stop
+                     there instead of at the physical end of the file. close()
+                     trims the unused preallocated space.
+        checksum_block: if > 0, a CRC32 checksum is maintained for every block of
+                        this many entries in a sidecar file (see btsf.checksum).
+        """
         # pylint:disable=protected-access
 
         if intro_sections:
@@ -128,8 +215,20 @@ class BinaryTimeSeriesFile:
         f._struct_size = f._struct.size
         f._byte_order = byte_order
         f._pad_to = pad_to
+        f._checksum_block = checksum_block
+        f._init_conversions()
         f._intro_sections = []
         f._populate_master_intro_section()
+        if preallocate:
+            f._intro_sections.append(
+                IntroSection(
+                    header=IntroSectionHeader(
+                        type=IntroSectionType.CommittedLength,
+                        payload_size=cls.COMMITTED_LENGTH.size,
+                    ),
+                    payload=cls.COMMITTED_LENGTH.pack(0, preallocate),
+                )
+            )
         f._intro_sections += intro_sections or []
         f._chunksize = max(
             cls._chunksize // f._struct_size * f._struct_size, f._struct_size
@@ -140,6 +239,13 @@ class BinaryTimeSeriesFile:
         f._write_all_intro_sections()
         f._write_end_of_intro()
         f._data_offset = f._fd.tell()
+        if checksum_block:
+            f._checksums = BlockChecksums.create(filename, checksum_block, f._struct_size)
+        if preallocate:
+            f._n_written = 0
+            f._extent = preallocate
+            f._allocated = f._data_offset
+            f._allocate(f._data_offset + 1)
         return f
 
     @property
@@ -159,6 +265,11 @@ class BinaryTimeSeriesFile:
             "struct_padding": self._struct_padding,
             "file_version": 0.1,
         }
+        if self._checksum_block:
+            data["checksums"] = {
+                "algorithm": BlockChecksums.ALGORITHM,
+                "block_entries": self._checksum_block,
+            }
         payload = json.dumps(data).encode("utf-8")
         ish = IntroSectionHeader(
             type=IntroSectionType.MasterIntro,
@@ -175,6 +286,8 @@ class BinaryTimeSeriesFile:
 
     def _write_all_intro_sections(self):
         for intro_section in self._intro_sections:
+            if intro_section.header.type == IntroSectionType.CommittedLength:
+                self._committed_offset = self._fd.tell() + IntroSectionHeader.STRUCT.size
             self._write_single_intro_section(intro_section)
 
     def _write_end_of_intro(self):
@@ -182,9 +295,160 @@ class BinaryTimeSeriesFile:
             IntroSection(IntroSectionHeader(type=IntroSectionType.EndOfIntro))
         )
 
+    def enable_stats(self, hook=None) -> IOStats:
+        """
+        Start collecting I/O counters and timings for this instance.
+
+        hook: optional callable invoked as hook(stats, operation, seconds)
+              after every timed operation (see btsf.stats.IOStats).
+        """
+        if self._stats is None:
+            self._stats = IOStats(hook=hook)
+            self._fd = CountingFile(self._fd, self._stats)
+        else:
+            self._stats.hook = hook
+        return self._stats
+
+    def disable_stats(self):
+        if self._stats is not None:
+            self._fd = self._fd._file
+            self._stats = None
+
+    def stats(self):
+        """
+        Return the collected I/O statistics as a dict
+        (empty if statistics were not enabled via enable_stats()).
+        """
+        if self._stats is None:
+            return {}
+        return self._stats.as_dict()
+
+    def _timed(self, operation):
+        if self._stats is None:
+            return contextlib.nullcontext()
+        return self._stats.timed(operation)
+
     def append(self, *values):
-        self.seekend()
-        self._fd.write(struct.pack(self._struct_format, *values))
+        if self._stats is not None:
+            with self._stats.timed("append"):
+                self._append(values)
+        else:
+            self._append(values)
+
+    def _append(self, values):
+        if self._conversions:
+            values = self._encode(values)
+        self._write_records(self._struct.pack(*values), 1)
+
+    def append_raw(self, data):
+        """
+        Append entries already packed according to the struct format of the
+        file (any bytes-like object holding a whole number of entries).
+        """
+        n_entries, trailing = divmod(memoryview(data).nbytes, self._struct_size)
+        if trailing:
+            raise InvalidFileContent(f"{trailing} trailing bytes in the data to append")
+        with self._timed("append"):
+            self._write_records(data, n_entries)
+
+    def _write_records(self, data, n_entries):
+        if self._n_written is None:
+            self.seekend()
+            self._fd.write(data)
+        else:
+            # preallocated file
+            pos = self._data_offset + self._n_written * self._struct_size
+            end = pos + n_entries * self._struct_size
+            if end > self._allocated:
+                self._allocate(end)
+            self._fd.seek(pos)
+            self._fd.write(data)
+            self._n_written += n_entries
+        if self._checksums is not None:
+            completed = self._checksums.update(data)
+            if completed:
+                # checksums must never reach the disk before their data
+                self._fd.flush()
+                self._checksums.write_records(completed)
+
+    def _pread(self, offset, size):
+        return os.pread(self._fd.fileno(), size, self._data_offset + offset)
+
+    def _verify_entries(self, start, stop):
+        block_entries = self._checksum_block
+        for block in range(start // block_entries, (stop - 1) // block_entries + 1):
+            verified = self._verified.get(block)
+            if verified == block_entries:
+                continue
+            record = self._checksums.load_record(block)
+            if record is None or record[0] == verified:
+                # no checksum (yet), e.g. recently appended entries,
+                # or the checksum of this partial block was verified before
+                continue
+            bad = self._checksums.verify_blocks([block], {block: record}, self._pread)
+            if bad:
+                raise ChecksumError(
+                    f"checksum mismatch for entries {bad[0].start}..{bad[0].stop - 1}"
+                )
+            self._verified[block] = record[0]
+
+    def verify_checksums(self, workers=None):
+        """
+        Verify all checksummed blocks of the file in parallel and return the
+        sorted list of ranges of corrupted entries (empty if all are fine).
+        """
+        with self._open_checksums() as checksums:
+            return checksums.verify(self._pread, self.n_entries, workers=workers)
+
+    def entries_without_checksum(self):
+        """
+        Return the ranges of entries not covered by any checksum, which
+        therefore can't be verified (e.g. after a crash of the writer).
+        """
+        with self._open_checksums() as checksums:
+            return checksums.uncovered(self.n_entries)
+
+    @contextlib.contextmanager
+    def _open_checksums(self):
+        if not self._checksum_block:
+            raise ChecksumError("the file has no checksums")
+        self._fd.flush()
+        checksums = self._checksums or BlockChecksums(
+            self._fdname, self._checksum_block, self._struct_size
+        )
+        try:
+            yield checksums
+        finally:
+            if checksums is not self._checksums:
+                checksums.close()
+
+    def _allocate(self, end):
+        # grow the file in whole extents, so that it covers at least `end`
+        n_extents = -(-(end - self._allocated) // self._extent)
+        size = n_extents * self._extent
+        self._fd.flush()
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self._fd.fileno(), self._allocated, size)
+        else:
+            os.ftruncate(self._fd.fileno(), self._allocated + size)
+        self._allocated += size
+
+    def _read_committed(self):
+        # a single pread bypasses the (possibly stale) read buffer of the file
+        data = os.pread(
+            self._fd.fileno(), self.COMMITTED_LENGTH.size, self._committed_offset
+        )
+        return self.COMMITTED_LENGTH.unpack(data)[0]
+
+    def _refresh_committed_end(self):
+        self._committed_end = self._data_offset + self.n_entries * self._struct_size
+        return self._committed_end
+
+    def _commit(self):
+        current_pos = self._fd.tell()
+        self._fd.seek(self._committed_offset)
+        self._fd.write(self.COMMITTED_LENGTH.pack(self._n_written, self._extent))
+        self._fd.seek(current_pos)
 
     def first(self):
         if self.n_entries == 0:
@@ -195,16 +459,33 @@ class BinaryTimeSeriesFile:
     def last(self):
         if self.n_entries == 0:
             raise EmptyBtsfError()
-        self._fd.seek(-self._struct_size, 2)  # SEEK_END
+        self.goto_entry(self.n_entries - 1)
         return next(self)
 
     def __next__(self):
+        if self._verify:
+            entry = (self._fd.tell() - self._data_offset) // self._struct_size
+            self._verify_entries(entry, entry + 1)
+        if self._committed_offset is not None:
+            pos = self._fd.tell()
+            if pos >= self._committed_end and pos >= self._refresh_committed_end():
+                raise NoFurtherData()
         data = self._fd.read(self._struct_size)
         if len(data) == 0:
             raise NoFurtherData()  # which also is a StopIteration
+        if self._stats is not None:
+            self._stats.counters["rows_decoded"] += 1
+        if self._conversions:
+            return self._decode(self._struct.unpack(data))
         return self._struct.unpack(data)
 
     def __getitem__(self, i):
+        if self._stats is not None:
+            with self._stats.timed("getitem"):
+                return self._getitem(i)
+        return self._getitem(i)
+
+    def _getitem(self, i):
         if i < 0:
             i += self.n_entries
         if 0 <= i < self.n_entries:
@@ -220,19 +501,51 @@ class BinaryTimeSeriesFile:
         A generator facilitating iterating over all entry tuples.
         """
         self.goto_entry(entry=0)
+        remaining = self.n_entries * self._struct_size
+        if self._stats is not None:
+            yield from self._iter_instrumented(remaining)
+            return
         # naive approach (slower than the one following)
         # buf = self._fd.read(self._struct_size)
         # while len(buf) == self._struct_size:
         #    yield self._struct.unpack(buf)
         #    buf = self._fd.read(self._struct_size)
-        buf = self._fd.read(self._chunksize)
+        decode = self._decode if self._conversions else None
+        entry = 0
+        buf = self._fd.read(min(self._chunksize, remaining))
         while buf:
+            if self._verify:
+                self._verify_entries(entry, entry + len(buf) // self._struct_size)
+                entry += len(buf) // self._struct_size
+            remaining -= len(buf)
             offset = 0
             buf_len = len(buf)
             while offset < buf_len:
-                yield self._struct.unpack_from(buf, offset=offset)
+                values = self._struct.unpack_from(buf, offset=offset)
+                yield decode(values) if decode else values
                 offset += self._struct_size
-            buf = self._fd.read(self._chunksize)
+            buf = self._fd.read(min(self._chunksize, remaining))
+
+    def _iter_instrumented(self, remaining):
+        # Decodes a whole chunk at a time, so that only the time spent
+        # in here (and not in the consumer of the generator) gets measured.
+        stats = self._stats
+        decode = self._decode if self._conversions else None
+        entry = 0
+        while True:
+            with stats.timed("iter"):
+                buf = self._fd.read(min(self._chunksize, remaining))
+                if self._verify and buf:
+                    self._verify_entries(entry, entry + len(buf) // self._struct_size)
+                    entry += len(buf) // self._struct_size
+                remaining -= len(buf)
+                rows = list(self._struct.iter_unpack(buf))
+                if decode:
+                    rows = [decode(values) for values in rows]
+                stats.counters["rows_decoded"] += len(rows)
+            if not rows:
+                return
+            yield from rows
 
     def goto_entry(self, entry=0):
         assert entry < self.n_entries
@@ -242,6 +555,18 @@ class BinaryTimeSeriesFile:
 
     @property
     def n_entries(self):
+        if self._n_written is not None:
+            return self._n_written
+        if self._committed_offset is not None:
+            n_committed = self._read_committed()
+            if n_committed != self._n_committed:
+                # entries committed meanwhile might have been read (as preallocated
+                # zeros) into the read buffer before, so it must be discarded
+                self._n_committed = n_committed
+                current_pos = self._fd.tell()
+                self._fd.seek(0, 2)  # SEEK_END never keeps the buffer
+                self._fd.seek(current_pos)
+            return n_committed
         current_pos = self._fd.tell()
         start = self._data_offset
         self.seekend()
@@ -256,9 +581,21 @@ class BinaryTimeSeriesFile:
         return n_data_bytes // self._struct_size
 
     def flush(self):
+        if self._n_written is not None:
+            self._commit()
         self._fd.flush()
+        if self._checksums is not None and not self._verify:
+            self._checksums.flush()
 
     def close(self):
+        if self._n_written is not None and not self._fd.closed:
+            self._commit()
+            self._fd.truncate(self._data_offset + self._n_written * self._struct_size)
+        if self._checksums is not None:
+            if not self._verify and not self._fd.closed:
+                self._fd.flush()
+                self._checksums.flush()
+            self._checksums.close()
         self._fd.close()
 
     # context manager protocol
@@ -0,0 +1,184 @@
+"""
+btsf.checksum
+
+Per-block CRC32 checksums of the entries of a BinaryTimeSeriesFile.
+
+The checksums are kept in a sidecar file next to the .btsf file (its name
+with ".crc" appended), declared in the master intro of the .btsf file.
+It holds one record per block of `block_entries` entries: the number of
+entries of the block covered by the checksum and the CRC32 of those entries.
+The last block might be covered only partially while a file is being written.
+"""
+
+import concurrent.futures
+import os
+import struct
+import zlib
+
+from .exceptions import ChecksumError
+
+__all__ = ["BlockChecksums"]
+
+
+class BlockChecksums:
+
+    SUFFIX = ".crc"
+    ALGORITHM = "crc32"
+    RECORD = struct.Struct("<LL")  # covered entries, crc32
+
+    def __init__(self, filename, block_entries, struct_size, mode="rb"):
+        self.block_entries = block_entries
+        self.struct_size = struct_size
+        self.block_size = block_entries * struct_size
+        self._fd = open(filename + self.SUFFIX, mode)
+        self._n_entries = 0
+        self._crc = 0
+
+    @classmethod
+    def create(cls, filename, block_entries, struct_size):
+        return cls(filename, block_entries, struct_size, mode="w+b")
+
+    @classmethod
+    def resume(cls, filename, block_entries, struct_size, n_entries, pread):
+        """
+        Open the checksums of an existing file for appending to it.
+        pread(offset, size) must return data from the record region of the file.
+        """
+        checksums = cls(filename, block_entries, struct_size, mode="r+b")
+        records = checksums.load()
+        n_complete = n_entries // block_entries
+        # Records of complete blocks lost in a crash of the writer are not
+        # recreated: their entries stay unverified (see uncovered()).
+        # recompute the running checksum of the last, incomplete block
+        offset = n_complete * checksums.block_size
+        data = pread(offset, (n_entries % block_entries) * struct_size)
+        crc = 0
+        # Records beyond the present entries are stale, e.g. of entries of a
+        # preallocated file never committed before a crash, and get removed.
+        # (the record of the last block is rewritten by the next flush())
+        n_records = n_complete
+        if len(records) > n_complete and records[n_complete][0] <= len(data) // struct_size:
+            n_records += 1
+            covered, expected = records[n_complete]
+            crc = zlib.crc32(data[: covered * struct_size])
+            if crc != expected:
+                bad = checksums.block_range(n_complete, covered)
+                raise ChecksumError(
+                    f"checksum mismatch for entries {bad.start}..{bad.stop - 1}"
+                )
+            data = data[covered * struct_size :]
+        checksums._fd.truncate(n_records * cls.RECORD.size)
+        checksums._crc = zlib.crc32(data, crc)
+        checksums._n_entries = n_entries
+        return checksums
+
+    def block_range(self, block, covered=None):
+        start = block * self.block_entries
+        if covered is None:
+            covered = self.block_entries
+        return range(start, start + covered)
+
+    def load(self):
+        """ Return the list of (covered entries, crc) records of all blocks """
+        self._fd.seek(0)
+        data = self._fd.read()
+        data = data[: len(data) // self.RECORD.size * self.RECORD.size]
+        return list(self.RECORD.iter_unpack(data))
+
+    def load_record(self, block):
+        """ Return the (covered entries, crc) record of a block or None """
+        # pread, as records might have been updated by a writer meanwhile
+        data = os.pread(self._fd.fileno(), self.RECORD.size, block * self.RECORD.size)
+        if len(data) < self.RECORD.size:
+            return None
+        return self.RECORD.unpack(data)
+
+    def uncovered(self, n_entries):
+        """
+        Return the ranges of the first n_entries entries which are not
+        covered by any checksum (e.g. after the writer crashed).
+        """
+        records = self.load()
+        ranges = []
+        for block in range(-(-n_entries // self.block_entries)):
+            start = block * self.block_entries
+            expected = min(self.block_entries, n_entries - start)
+            covered = records[block][0] if block < len(records) else 0
+            if covered >= expected:
+                continue
+            if ranges and ranges[-1].stop == start + covered:
+                ranges[-1] = range(ranges[-1].start, start + expected)
+            else:
+                ranges.append(range(start + covered, start + expected))
+        return ranges
+
+    def update(self, data):
+        """
+        Account newly appended entries. Returns the records of the blocks
+        completed by them, which should be stored (and get flushed) with
+        write_records() once the data itself has been flushed.
+        """
+        completed = []
+        view = memoryview(data).cast("B")
+        offset = 0
+        while offset < len(view):
+            in_block = self._n_entries % self.block_entries
+            take = min(self.block_entries - in_block, (len(view) - offset) // self.struct_size)
+            end = offset + take * self.struct_size
+            self._crc = zlib.crc32(view[offset:end], self._crc)
+            self._n_entries += take
+            offset = end
+            if self._n_entries % self.block_entries == 0:
+                block = self._n_entries // self.block_entries - 1
+                completed.append((block, self.block_entries, self._crc))
+                self._crc = 0
+        return completed
+
+    def write_records(self, records):
+        for block, covered, crc in records:
+            self._fd.seek(block * self.RECORD.size)
+            self._fd.write(self.RECORD.pack(covered, crc))
+        self._fd.flush()
+
+    def flush(self):
+        """ Store the checksum of the last incomplete block and flush """
+        covered = self._n_entries % self.block_entries
+        if covered:
+            block = self._n_entries // self.block_entries
+            self.write_records([(block, covered, self._crc)])
+        self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+    def verify_blocks(self, blocks, records, pread):
+        """
+        Check the given blocks against their records (a sequence or mapping
+        indexed by block) and return the ranges of entries found to be corrupted.
+        """
+        bad = []
+        for block in blocks:
+            covered, expected = records[block]
+            size = covered * self.struct_size
+            data = pread(block * self.block_size, size)
+            if len(data) != size or zlib.crc32(data) != expected:
+                bad.append(self.block_range(block, covered))
+        return bad
+
+    def verify(self, pread, n_entries, workers=None, blocks_per_task=16):
+        """
+        Verify the blocks of the first n_entries entries having a checksum
+        (see uncovered() for the others), using a pool of worker threads
+        (zlib.crc32 releases the GIL). Returns the sorted list of ranges of
+        corrupted entries.
+        """
+        records = self.load()[: -(-n_entries // self.block_entries)]
+        blocks = [block for block, (covered, _) in enumerate(records) if covered]
+        tasks = [
+            blocks[i : i + blocks_per_task] for i in range(0, len(blocks), blocks_per_task)
+        ]
+        with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            results = pool.map(lambda b: self.verify_blocks(b, records, pread), tasks)
+            return sorted(
+                (r for result in results for r in result), key=lambda r: r.start
+            )
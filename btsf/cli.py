@@ -49,6 +49,45 @@ def export(args):
             raise NotImplementedError
 
 
+def verify(args):
+    import sys
+    from .exceptions import BtsfError
+
+    with BinaryTimeSeriesFile.openread(args.btsf_file) as f:
+        try:
+            bad = f.verify_checksums(workers=args.jobs)
+            unverified = f.entries_without_checksum()
+        except (BtsfError, OSError) as e:
+            sys.exit(f"{args.btsf_file}: cannot verify: {e}")
+        n_entries = f.n_entries
+    if bad:
+        first = bad[0]
+        n_bad = sum(len(r) for r in bad)
+        sys.exit(
+            f"{args.btsf_file}: CORRUPTED - first bad entries: {first.start}..{first.stop - 1} "
+            f"({n_bad} entries in {len(bad)} blocks affected)"
+        )
+    if unverified:
+        first = unverified[0]
+        n_unverified = sum(len(r) for r in unverified)
+        sys.stderr.write(
+            f"{args.btsf_file}: UNVERIFIED - {n_unverified} of {n_entries} entries have "
+            f"no checksum, first: {first.start}..{first.stop - 1}\n"
+        )
+        sys.exit(2)
+    print(f"{args.btsf_file}: OK ({n_entries} entries)")
+
+
+def serve(args):
+    import sys
+    from .server import serve as serve_directory
+
+    sys.stderr.write(
+        f"Serving {args.directory} on http://{args.host}:{args.port}/\n"
+    )
+    serve_directory(args.directory, args.host, args.port, max_rows=args.max_rows)
+
+
 def main():
     import argparse
 
@@ -76,5 +115,25 @@ def main():
     )
     export_parser.set_defaults(func=export)
 
+    verify_parser = subparsers.add_parser(
+        "verify",
+        help="check the block checksums "
+        "(exit status 1: corrupted entries, 2: entries without checksum)",
+    )
+    verify_parser.add_argument(
+        "--jobs", "-j", default=None, type=int, metavar="n", help="number of threads"
+    )
+    verify_parser.add_argument("btsf_file")
+    verify_parser.set_defaults(func=verify)
+
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", "-p", default=8080, type=int)
+    serve_parser.add_argument(
+        "--max-rows", default=1000000, type=int, help="max rows per request"
+    )
+    serve_parser.add_argument("directory")
+    serve_parser.set_defaults(func=serve)
+
     args = parser.parse_args()
     args.func(args)
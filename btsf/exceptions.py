@@ -24,3 +24,11 @@ class InvalidFileContent(BtsfNameError):
 
 class InvalidIntroSection(BtsfNameError):
     pass
+
+
+class InvalidMetric(BtsfNameError):
+    pass
+
+
+class ChecksumError(BtsfError):
+    pass
@@ -12,6 +12,7 @@ class IntroSectionType(enum.IntEnum):
     MasterIntro = 0x1
     Annotations = 0x2
     GenericBinary = 0x3
+    CommittedLength = 0x4
 
 
 @attr.s
@@ -2,37 +2,121 @@ import enum
 
 import attr
 
+from .exceptions import InvalidMetric
+
 __all__ = ["Metric", "MetricType"]
 
 
 class MetricType(enum.Enum):
     # pylint:disable=bad-whitespace
     # fmt: off
-    Float =  "f"
-    Double = "d"
-    Int8 =   "b"
-    UInt8 =  "B"
-    Int16 =  "h"
-    UInt16 = "H"
-    Int32 =  "l"
-    UInt32 = "L"
-    Int64 =  "q"
-    UInt64 = "Q"
+    Float16 = "e"
+    Float =   "f"
+    Double =  "d"
+    Bool =    "?"
+    Int8 =    "b"
+    UInt8 =   "B"
+    Int16 =   "h"
+    UInt16 =  "H"
+    Int32 =   "l"
+    UInt32 =  "L"
+    Int64 =   "q"
+    UInt64 =  "Q"
     # fmt: on
 
 
+INTEGER_TYPES = {
+    MetricType.Int8: 8,
+    MetricType.UInt8: 8,
+    MetricType.Int16: 16,
+    MetricType.UInt16: 16,
+    MetricType.Int32: 32,
+    MetricType.UInt32: 32,
+    MetricType.Int64: 64,
+    MetricType.UInt64: 64,
+}
+
+UNSIGNED_TYPES = {
+    MetricType.UInt8,
+    MetricType.UInt16,
+    MetricType.UInt32,
+    MetricType.UInt64,
+}
+
+
 @attr.s
 class Metric:
+    """
+    A single value stored with every entry of a BinaryTimeSeriesFile.
+
+    Integer metrics can be stored in a compact way and still be presented
+    in physical units:
+
+    scale, offset: the stored integer `raw` represents `raw * scale + offset`.
+    flags: names of boolean flags packed into the bits of an unsigned integer
+           (first flag in the least significant bit). Entries then carry a
+           tuple of bools for this metric.
+    """
+
     identifier = attr.ib()
     type = attr.ib(type=MetricType)
     name = attr.ib(default="", type=str)
     unit = attr.ib(default="", type=str)
     description = attr.ib(default="", type=str)
     is_time = attr.ib(default=False, type=bool)
+    scale = attr.ib(default=None, type=float)
+    offset = attr.ib(default=None, type=float)
+    flags = attr.ib(default=None, type=list)
+
+    def __attrs_post_init__(self):
+        if self.is_scaled and self.type not in INTEGER_TYPES:
+            raise InvalidMetric(f"{self.identifier}: scale/offset require an integer type")
+        if self.flags is not None:
+            if self.is_scaled:
+                raise InvalidMetric(f"{self.identifier}: flags cannot be scaled")
+            if self.type not in UNSIGNED_TYPES:
+                raise InvalidMetric(f"{self.identifier}: flags require an unsigned integer type")
+            if not 0 < len(self.flags) <= INTEGER_TYPES[self.type]:
+                raise InvalidMetric(
+                    f"{self.identifier}: {len(self.flags)} flags don't fit into {self.type}"
+                )
+            self.flags = list(self.flags)
+
+    @property
+    def is_scaled(self):
+        return self.scale is not None or self.offset is not None
+
+    @property
+    def needs_conversion(self):
+        """ True if stored values differ from the values presented to the user """
+        return self.is_scaled or self.flags is not None
+
+    def encode(self, value):
+        """ Convert a user-facing value into the value to be packed into the file """
+        if self.is_scaled:
+            return round((value - (self.offset or 0.0)) / (self.scale or 1.0))
+        if self.flags is not None:
+            if isinstance(value, int):
+                return value
+            return sum(1 << i for i, bit in enumerate(value) if bit)
+        return value
+
+    def decode(self, raw):
+        """ Convert a value unpacked from the file into its user-facing value """
+        if self.is_scaled:
+            return raw * (self.scale or 1.0) + (self.offset or 0.0)
+        if self.flags is not None:
+            return tuple(bool(raw >> i & 1) for i in range(len(self.flags)))
+        return raw
 
     def to_dict(self):
         d = attr.asdict(self)
         d["type"] = self.type.value
+        # leave out unused optional attributes, keeping files of plain
+        # metrics readable by earlier versions of btsf
+        for key in ("scale", "offset", "flags"):
+            if d[key] is None:
+                del d[key]
         return d
         # return {
         #    'identifier': self.identifier,
@@ -0,0 +1,350 @@
+"""
+btsf.server
+
+A small read-only HTTP server giving access to all .btsf files below a
+directory, built on the standard library only. Start it with:
+
+    btsf serve DIR
+
+Endpoints (all GET):
+
+    /                       list of the available files
+    /<file>                 metadata: metrics, struct layout, number of entries
+    /<file>/rows            rows by index:  ?start=&stop=&step=
+    /<file>/time            rows by time:   ?t0=&t1=&step=
+                            (using the is_time metric, or the first metric)
+
+The row endpoints accept ?points=N to downsample the selection to at most N
+evenly spaced rows and ?format=json|binary. In JSON, NaN and infinite values
+are given as null. Binary responses contain the records exactly as stored in
+the file (see the X-Btsf-* response headers).
+
+Open files and their parsed intro sections are cached; rows are read with
+os.pread(), so concurrent requests don't interfere with each other.
+"""
+
+import http.server
+import json
+import math
+import os
+import stat
+import struct
+import threading
+import urllib.parse
+
+from .btsf import BinaryTimeSeriesFile
+from .exceptions import BtsfError
+
+__all__ = ["make_server", "serve"]
+
+# errors raised when opening or decoding truncated or malformed files
+_FILE_ERRORS = (
+    BtsfError,
+    struct.error,
+    AssertionError,
+    KeyError,
+    TypeError,
+    ValueError,
+    OSError,
+)
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _CachedFile:
+    """ An opened BinaryTimeSeriesFile shared between request handlers """
+
+    def __init__(self, path):
+        self.f = BinaryTimeSeriesFile.openread(path)
+        self.fileno = self.f._fd.fileno()
+        st = os.fstat(self.fileno)
+        self.identity = (st.st_dev, st.st_ino)
+        self.time_index = next(
+            (i for i, m in enumerate(self.f.metrics) if m.is_time), 0
+        )
+
+    @property
+    def n_entries(self):
+        f = self.f
+        if f._committed_offset is not None:
+            return f._read_committed()
+        # The file might currently be appended to, so a trailing
+        # incomplete record is ignored instead of raising an error.
+        size = os.fstat(self.fileno).st_size
+        return (size - f._data_offset) // f._struct_size
+
+    def metadata(self):
+        f = self.f
+        return {
+            "metrics": [m.to_dict() for m in f.metrics],
+            "struct_format": f._struct_format,
+            "struct_size": f._struct_size,
+            "byte_order": f._byte_order,
+            "n_entries": self.n_entries,
+        }
+
+    def read(self, rows: range) -> bytes:
+        """ Return the raw records selected by rows (a range with step > 0) """
+        size = self.f._struct_size
+        if not rows:
+            return b""
+        if rows.step == 1:
+            return self._pread(rows.start * size, len(rows) * size)
+        if rows.step * size > 64 * 1024:
+            # sparse selection: read the records one by one
+            return b"".join(self._pread(i * size, size) for i in rows)
+        # dense selection: read contiguous blocks and pick the records
+        out = []
+        per_block = max(1, (1024 * 1024) // (rows.step * size))
+        for first in range(0, len(rows), per_block):
+            block = rows[first : first + per_block]
+            buf = self._pread(block.start * size, (block[-1] - block.start + 1) * size)
+            view = memoryview(buf)
+            out.extend(
+                view[offset : offset + size]
+                for offset in range(0, len(buf), rows.step * size)
+            )
+        return b"".join(out)
+
+    def _pread(self, offset, length):
+        return os.pread(self.fileno, length, self.f._data_offset + offset)
+
+    def decode(self, data: bytes):
+        f = self.f
+        rows = f._struct.iter_unpack(data)
+        if f._conversions:
+            return [f._decode(values) for values in rows]
+        return list(rows)
+
+    def time_at(self, i):
+        return self.decode(self.read(range(i, i + 1)))[0][self.time_index]
+
+    def bisect_time(self, t, n):
+        """ Return the first row with time >= t, assuming ascending times """
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def close(self):
+        self.f.close()
+
+
+class _FileCache:
+    def __init__(self, directory):
+        self.directory = os.path.realpath(directory)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def list(self):
+        names = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".btsf"):
+                    path = os.path.join(root, name)
+                    names.append(os.path.relpath(path, self.directory))
+        return sorted(names)
+
+    def get(self, name) -> _CachedFile:
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep) or not name.endswith(".btsf"):
+            raise _HTTPError(404, f"no such file: {name}")
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise _HTTPError(404, f"no such file: {name}")
+        if not stat.S_ISREG(st.st_mode):
+            raise _HTTPError(404, f"no such file: {name}")
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached.identity != (st.st_dev, st.st_ino):
+                # the file got replaced, open it again
+                cached.close()
+                cached = None
+            if cached is None:
+                try:
+                    cached = _CachedFile(path)
+                except _FILE_ERRORS as e:
+                    raise _HTTPError(415, f"{name}: unreadable file ({e!r})")
+                self._files[path] = cached
+            return cached
+
+    def close(self):
+        with self._lock:
+            for cached in self._files.values():
+                cached.close()
+            self._files.clear()
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    server_version = "btsf"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = urllib.parse.unquote(url.path).strip("/")
+        try:
+            if not path:
+                return self._send_json({"files": self.server.cache.list()})
+            # the endpoint is the last path component (if it isn't the file),
+            # directories might have a .btsf suffix as well
+            name, _, endpoint = path.rpartition("/")
+            if not name or endpoint.endswith(".btsf"):
+                name, endpoint = path, ""
+            cached = self.server.cache.get(name)
+            if not endpoint:
+                return self._send_json(cached.metadata())
+            if endpoint == "rows":
+                rows = self._rows_by_index(cached, query)
+            elif endpoint == "time":
+                rows = self._rows_by_time(cached, query)
+            else:
+                raise _HTTPError(404, f"unknown endpoint: {endpoint}")
+            self._send_rows(cached, rows, query)
+        except _HTTPError as e:
+            self._send_json({"error": e.message}, status=e.status)
+        except _FILE_ERRORS as e:
+            self.log_error("error reading %s: %r", path, e)
+            self._send_json({"error": f"cannot read {path}: {e!r}"}, status=500)
+        except Exception as e:  # pylint:disable=broad-except
+            self.log_error("internal error handling %s: %r", self.path, e)
+            self._send_json({"error": "internal server error"}, status=500)
+
+    def _rows_by_index(self, cached, query):
+        n = cached.n_entries
+        start = _int_param(query, "start")
+        stop = _int_param(query, "stop")
+        step = _int_param(query, "step")
+        if step is not None and step < 1:
+            raise _HTTPError(400, "step must be positive")
+        return range(*slice(start, stop, step).indices(n))
+
+    def _rows_by_time(self, cached, query):
+        n = cached.n_entries
+        t0 = _float_param(query, "t0")
+        t1 = _float_param(query, "t1")
+        step = _int_param(query, "step") or 1
+        if step < 1:
+            raise _HTTPError(400, "step must be positive")
+        start = 0 if t0 is None else cached.bisect_time(t0, n)
+        stop = n if t1 is None else cached.bisect_time(t1, n)
+        return range(start, max(start, stop), step)
+
+    def _send_rows(self, cached, rows, query):
+        points = _int_param(query, "points")
+        if points is not None:
+            if points < 1:
+                raise _HTTPError(400, "points must be positive")
+            if len(rows) > points:
+                rows = rows[:: math.ceil(len(rows) / points)]
+        if len(rows) > self.server.max_rows:
+            raise _HTTPError(
+                413,
+                f"{len(rows)} rows requested, at most {self.server.max_rows} allowed",
+            )
+        data = cached.read(rows)
+        fmt = query.get("format", "json")
+        if fmt == "binary":
+            f = cached.f
+            headers = {
+                "X-Btsf-Struct-Format": f._struct_format,
+                "X-Btsf-Struct-Size": str(f._struct_size),
+                "X-Btsf-Rows": f"{rows.start}:{rows.stop}:{rows.step}",
+            }
+            return self._send(data, "application/octet-stream", headers=headers)
+        if fmt == "json":
+            return self._send_json(
+                {
+                    "columns": [m.identifier for m in cached.f.metrics],
+                    "start": rows.start,
+                    "stop": rows.stop,
+                    "step": rows.step,
+                    "rows": [_finite(values) for values in cached.decode(data)],
+                }
+            )
+        raise _HTTPError(400, f"unknown format: {fmt}")
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj, allow_nan=False).encode("utf-8")
+        self._send(body, "application/json", status=status)
+
+    def _send(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _finite(values):
+    """ Replace NaN and infinite values (not valid in JSON) by None (null) """
+    return [
+        None if isinstance(v, float) and not math.isfinite(v) else v for v in values
+    ]
+
+
+def _int_param(query, key):
+    try:
+        return int(query[key]) if key in query else None
+    except ValueError:
+        raise _HTTPError(400, f"{key} must be an integer")
+
+
+def _float_param(query, key):
+    try:
+        return float(query[key]) if key in query else None
+    except ValueError:
+        raise _HTTPError(400, f"{key} must be a number")
+
+
+class _Server(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        self.cache.close()
+
+
+def make_server(
+    directory: str,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    max_rows: int = 1000000,
+    quiet: bool = False,
+):
+    """
+    Create (but don't start) an HTTP server for the .btsf files in directory.
+    Call serve_forever() on the returned object to handle requests.
+
+    max_rows: upper limit for the number of rows returned by a single request
+    """
+    server = _Server((host, port), _RequestHandler)
+    server.cache = _FileCache(directory)
+    server.max_rows = max_rows
+    server.quiet = quiet
+    return server
+
+
+def serve(directory: str, host: str = "127.0.0.1", port: int = 8080, **kwargs):
+    with make_server(directory, host, port, **kwargs) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
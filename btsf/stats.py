@@ -0,0 +1,115 @@
+"""
+btsf.stats
+
+Optional I/O instrumentation for BinaryTimeSeriesFile instances.
+It is switched off by default; see BinaryTimeSeriesFile.enable_stats().
+"""
+
+import contextlib
+import time
+
+__all__ = ["IOStats"]
+
+
+class IOStats:
+    """
+    Counters and timings collected by an instrumented BinaryTimeSeriesFile.
+
+    hook: optional callable invoked as hook(stats, operation, seconds) after
+          every timed operation, e.g. to forward the numbers to an exporter.
+    """
+
+    COUNTERS = (
+        "bytes_read",
+        "bytes_written",
+        "read_calls",
+        "write_calls",
+        "seeks",
+        "rows_decoded",
+    )
+    TIMERS = ("append", "iter", "getitem", "to_numpy", "to_arrow")
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.reset()
+
+    def reset(self):
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.seconds = dict.fromkeys(self.TIMERS, 0.0)
+        self.calls = dict.fromkeys(self.TIMERS, 0)
+
+    def add(self, counter, n=1):
+        self.counters[counter] += n
+
+    @contextlib.contextmanager
+    def timed(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[operation] += elapsed
+            self.calls[operation] += 1
+            if self.hook is not None:
+                self.hook(self, operation, elapsed)
+
+    def as_dict(self):
+        d = dict(self.counters)
+        for operation in self.TIMERS:
+            d[operation + "_calls"] = self.calls[operation]
+            d[operation + "_seconds"] = self.seconds[operation]
+        return d
+
+    def to_prometheus(self, prefix="btsf", labels=None):
+        """
+        Render the statistics in the Prometheus text exposition format.
+
+        labels: optional dict of labels attached to every sample
+        """
+        label_str = ""
+        if labels:
+            label_str = "{%s}" % ",".join(
+                '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                for k, v in labels.items()
+            )
+        lines = []
+        for counter, value in self.counters.items():
+            name = f"{prefix}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{label_str} {value}")
+        for operation in self.TIMERS:
+            name = f"{prefix}_{operation}_seconds"
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f"{name}_sum{label_str} {self.seconds[operation]}")
+            lines.append(f"{name}_count{label_str} {self.calls[operation]}")
+        return "\n".join(lines) + "\n"
+
+
+class CountingFile:
+    """
+    Wraps a binary file object and accounts all reads, writes and seeks
+    to an IOStats instance. Everything else is passed on to the file.
+    """
+
+    def __init__(self, fd, stats: IOStats):
+        self._file = fd
+        self._stats = stats
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._stats.counters["read_calls"] += 1
+        self._stats.counters["bytes_read"] += len(data)
+        return data
+
+    def write(self, data):
+        n = self._file.write(data)
+        self._stats.counters["write_calls"] += 1
+        self._stats.counters["bytes_written"] += n
+        return n
+
+    def seek(self, offset, whence=0):
+        self._stats.counters["seeks"] += 1
+        return self._file.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
@@ -5,18 +5,34 @@ A module with helper functions to work with btsf data,
 typically acting on a BinaryTimeSeriesFile instance.
 """
 
-from typing import Union
+import json
+import math
+import os
+from typing import List, Sequence, Tuple, Union
 
 from .btsf import BinaryTimeSeriesFile
+from .checksum import BlockChecksums
+from .exceptions import BtsfError, BtsfNameError, InvalidMetric
 from .metric import Metric, MetricType
 
-__all__ = ["to_numpy", "to_pandas"]
+__all__ = [
+    "to_numpy",
+    "to_pandas",
+    "to_arrow",
+    "to_parquet",
+    "from_arrow",
+    "from_parquet",
+    "resample",
+    "resample_to_btsf",
+]
 
 
 def to_numpy(f: BinaryTimeSeriesFile, output="structured"):
     """
     Return the data stored in a BinaryTimeSeriesFile as structured numpy.array or
     as a tuple of the columns as numpy.array, depending on the output parameter.
+    Scaled integer metrics are returned as float64 in physical units, bit flag
+    metrics as boolean sub-arrays with one element per flag.
 
     f: The BinaryTimeSeriesFile instance to convert
     output: ('structured', 'columns')
@@ -26,32 +42,92 @@ def to_numpy(f: BinaryTimeSeriesFile, output="structured"):
     """
     import numpy as np
 
-    np_dtype_map = {
-        MetricType.Double: f._byte_order + "f8",
-        MetricType.Float: f._byte_order + "f4",
-        MetricType.Int8: f._byte_order + "i1",
-        MetricType.UInt8: f._byte_order + "u1",
-        MetricType.Int16: f._byte_order + "i2",
-        MetricType.UInt16: f._byte_order + "u2",
-        MetricType.Int32: f._byte_order + "i4",
-        MetricType.UInt32: f._byte_order + "u4",
-        MetricType.Int64: f._byte_order + "i8",
-        MetricType.UInt64: f._byte_order + "u8",
-    }
-    dt = np.dtype(
+    dt = _numpy_dtype(f)
+    with f._timed("to_numpy"):
+        n_entries = f.n_entries
+        if f._verify and n_entries:
+            f._verify_entries(0, n_entries)
+        f.goto_entry(entry=0)
+        a = np.fromfile(f._fd, dtype=dt, count=n_entries, offset=0)
+        if f._stats is not None:
+            f._stats.add("read_calls")
+            f._stats.add("bytes_read", a.nbytes)
+            f._stats.add("rows_decoded", len(a))
+        if any(m.needs_conversion for m in f.metrics):
+            a = _decode_structured(a, f.metrics)
+    if output == "structured":
+        return a
+    if output == "columns":
+        return (a[name] for name in a.dtype.names)
+
+
+NP_DTYPE_MAP = {
+    MetricType.Double: "f8",
+    MetricType.Float: "f4",
+    MetricType.Float16: "f2",
+    MetricType.Bool: "b1",
+    MetricType.Int8: "i1",
+    MetricType.UInt8: "u1",
+    MetricType.Int16: "i2",
+    MetricType.UInt16: "u2",
+    MetricType.Int32: "i4",
+    MetricType.UInt32: "u4",
+    MetricType.Int64: "i8",
+    MetricType.UInt64: "u8",
+}
+
+
+def _numpy_dtype(f: BinaryTimeSeriesFile):
+    """ The structured numpy.dtype matching the records as stored in the file """
+    import numpy as np
+
+    return np.dtype(
         {
             "names": tuple(m.identifier for m in f.metrics),
-            "formats": tuple(np_dtype_map[m.type] for m in f.metrics),
+            "formats": tuple(f._byte_order + NP_DTYPE_MAP[m.type] for m in f.metrics),
             # "titles": tuple(f"{m.name} - {m.description}" or None for m in f.metrics),
             "itemsize": f._struct_size,
         }
     )
-    f.goto_entry(entry=0)
-    a = np.fromfile(f._fd, dtype=dt, offset=0)
-    if output == "structured":
-        return a
-    if output == "columns":
-        return (a[name] for name in a.dtype.names)
+
+
+def _decode_column(m: Metric, raw):
+    """
+    Convert the stored values `raw` (numpy.array) of metric m into their
+    user-facing values (float64 for scaled metrics, bool 2D-array for flags)
+    """
+    import numpy as np
+
+    if m.is_scaled:
+        return raw * (m.scale or 1.0) + (m.offset or 0.0)
+    if m.flags is not None:
+        bits = np.arange(len(m.flags), dtype=raw.dtype)
+        return ((raw[:, np.newaxis] >> bits) & 1).astype(bool)
+    return raw
+
+
+def _decode_structured(a, metrics):
+    """
+    Convert the raw structured array `a` read from a file into one holding
+    the user-facing values of scaled integer and bit flag metrics.
+    """
+    import numpy as np
+
+    formats = []
+    for m in metrics:
+        if m.is_scaled:
+            formats.append("f8")
+        elif m.flags is not None:
+            formats.append(("?", (len(m.flags),)))
+        else:
+            formats.append(a.dtype[m.identifier])
+    out = np.empty(
+        a.shape,
+        dtype={"names": tuple(m.identifier for m in metrics), "formats": formats},
+    )
+    for m in metrics:
+        out[m.identifier] = _decode_column(m, a[m.identifier])
+    return out
 
 
 def to_pandas(f: BinaryTimeSeriesFile, index_metric: Union[Metric, str, int, None] = 0):
@@ -66,16 +142,33 @@ def to_pandas(f: BinaryTimeSeriesFile, index_metric: Union[Metric, str, int, Non
                       * a string representing the Metric's identifier
                       * an integer specifying the zero-based metric's index
                   By default, first metric will become the index column.
+    Bit flag metrics are expanded into one boolean column per flag,
+    named "<identifier>.<flag>".
     """
     import pandas as pd
 
     a = to_numpy(f)
-    df = pd.DataFrame.from_records(a)
+    if any(m.flags is not None for m in f._metrics):
+        columns = {}
+        for m in f._metrics:
+            if m.flags is not None:
+                for j, flag in enumerate(m.flags):
+                    columns[f"{m.identifier}.{flag}"] = a[m.identifier][:, j]
+            else:
+                columns[m.identifier] = a[m.identifier]
+        df = pd.DataFrame(columns)
+    else:
+        df = pd.DataFrame.from_records(a)
     index_column_name = None
     for i, m in enumerate(f._metrics):
         if type(index_metric) is Metric and m == index_metric or \
            type(index_metric) is str and m.identifier == index_metric or \
            type(index_metric) is int and i == index_metric:
+            if m.flags is not None:
+                raise BtsfNameError(
+                    f"bit flag metric {m.identifier} can't be the index, "
+                    "as it's expanded into one column per flag"
+                )
             index_column_name = m.identifier
             break
     if (index_metric is not None) and (not index_column_name):
@@ -83,3 +176,496 @@ def to_pandas(f: BinaryTimeSeriesFile, index_metric: Union[Metric, str, int, Non
     if index_column_name:
         df.set_index(index_column_name, inplace=True)
     return df
+
+
+# metadata key of Arrow fields holding the full btsf Metric definition as JSON
+ARROW_METRIC_KEY = b"btsf.metric"
+
+
+def _arrow_type(m: Metric):
+    import pyarrow as pa
+
+    if m.is_scaled:
+        return pa.float64()
+    if m.flags is not None:
+        return pa.struct([pa.field(flag, pa.bool_()) for flag in m.flags])
+    return pa.from_numpy_dtype(NP_DTYPE_MAP[m.type])
+
+
+def _arrow_field(m: Metric):
+    import pyarrow as pa
+
+    metadata = {ARROW_METRIC_KEY: json.dumps(m.to_dict())}
+    if m.unit:
+        metadata[b"unit"] = m.unit
+    if m.description:
+        metadata[b"description"] = m.description
+    return pa.field(m.identifier, _arrow_type(m), nullable=False, metadata=metadata)
+
+
+def _metric_from_arrow_field(field, is_time=None) -> Metric:
+    """ is_time: overrides is_time of the field (if not None) """
+    import numpy as np
+
+    metadata = field.metadata or {}
+    if ARROW_METRIC_KEY in metadata:
+        d = json.loads(metadata[ARROW_METRIC_KEY].decode("utf-8"))
+        d = dict(d, identifier=field.name, type=MetricType(d["type"]))
+        if is_time is not None:
+            d["is_time"] = is_time
+        return Metric(**d)
+    try:
+        dtype = np.dtype(field.type.to_pandas_dtype())
+    except (NotImplementedError, TypeError):
+        dtype = None
+    type_map = {np.dtype(v): k for k, v in NP_DTYPE_MAP.items()}
+    if dtype not in type_map:
+        raise InvalidMetric(f"{field.name}: unsupported Arrow type {field.type}")
+    return Metric(
+        field.name,
+        type_map[dtype],
+        unit=metadata.get(b"unit", b"").decode("utf-8"),
+        description=metadata.get(b"description", b"").decode("utf-8"),
+        is_time=bool(is_time),
+    )
+
+
+def to_arrow(
+    f: BinaryTimeSeriesFile,
+    columns: List[str] = None,
+    start: int = 0,
+    stop: int = None,
+):
+    """
+    Return (a part of) the data stored in a BinaryTimeSeriesFile as pyarrow.Table.
+
+    The record region of the file is memory-mapped and each requested column
+    is copied exactly once into a contiguous Arrow array. Unit, description and
+    the full Metric definition are kept in the metadata of the Arrow fields.
+    Scaled integer metrics become float64 columns, bit flag metrics struct
+    columns with one bool field per flag.
+
+    f: The BinaryTimeSeriesFile instance to convert
+    columns: identifiers of the metrics to include (default: all)
+    start, stop: range of entries to include (like slice indices)
+    """
+    import mmap
+
+    import numpy as np
+    import pyarrow as pa
+
+    by_identifier = {m.identifier: m for m in f.metrics}
+    if columns is None:
+        columns = list(by_identifier)
+    for identifier in columns:
+        if identifier not in by_identifier:
+            raise BtsfNameError(f"metric {identifier} not found in the data")
+
+    with f._timed("to_arrow"):
+        start, stop, _ = slice(start, stop).indices(f.n_entries)
+        count = max(0, stop - start)
+        dt = _numpy_dtype(f)
+        mm = None
+        if f._verify and count:
+            f._verify_entries(start, stop)
+        if count:
+            f._fd.flush()
+            mm = mmap.mmap(f._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            a = np.frombuffer(
+                mm, dtype=dt, count=count, offset=f._data_offset + start * f._struct_size
+            )
+        else:
+            a = np.empty(0, dtype=dt)
+        try:
+            arrays = []
+            for identifier in columns:
+                m = by_identifier[identifier]
+                # copy the (strided) column into native byte order
+                col = _decode_column(m, a[identifier].astype(NP_DTYPE_MAP[m.type]))
+                if m.flags is not None:
+                    arrays.append(
+                        pa.StructArray.from_arrays(
+                            [pa.array(col[:, j]) for j in range(len(m.flags))],
+                            fields=list(_arrow_type(m)),
+                        )
+                    )
+                else:
+                    arrays.append(pa.array(col))
+        finally:
+            del a
+            if mm is not None:
+                mm.close()
+        if f._stats is not None:
+            f._stats.add("bytes_read", count * f._struct_size)
+            f._stats.add("rows_decoded", count)
+
+    schema = pa.schema([_arrow_field(by_identifier[c]) for c in columns])
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def to_parquet(f: BinaryTimeSeriesFile, where, **kwargs):
+    """
+    Write the data stored in a BinaryTimeSeriesFile to a Parquet file.
+    The keyword arguments columns, start and stop are passed on to to_arrow(),
+    all others to pyarrow.parquet.write_table().
+    """
+    import pyarrow.parquet as pq
+
+    to_arrow_kwargs = {k: kwargs.pop(k) for k in ("columns", "start", "stop") if k in kwargs}
+    pq.write_table(to_arrow(f, **to_arrow_kwargs), where, **kwargs)
+
+
+def _encode_batch(batch, metrics, dt):
+    """ Pack a pyarrow.RecordBatch into records as stored in the file """
+    import numpy as np
+    import pyarrow as pa
+
+    a = np.zeros(batch.num_rows, dtype=dt)
+    for m in metrics:
+        column = batch.column(m.identifier)
+        if column.null_count:
+            raise BtsfError(f"{m.identifier}: null values can't be stored")
+        if m.flags is not None and pa.types.is_struct(column.type):
+            raw = np.zeros(batch.num_rows, dtype=dt[m.identifier])
+            for j, child in enumerate(column.flatten()):
+                bits = child.to_numpy(zero_copy_only=False).astype(raw.dtype)
+                raw |= bits << j
+            a[m.identifier] = raw
+            continue
+        values = column.to_numpy(zero_copy_only=False)
+        if m.is_scaled:
+            values = np.round((values - (m.offset or 0.0)) / (m.scale or 1.0))
+        a[m.identifier] = values
+    return a
+
+
+def _write_batches(filename, schema, batches, time_column, create_kwargs):
+    if time_column is not None and time_column not in schema.names:
+        raise BtsfNameError(f"time column {time_column} not found in the data")
+    metrics = [
+        _metric_from_arrow_field(
+            field, is_time=None if time_column is None else field.name == time_column
+        )
+        for field in schema
+    ]
+    f = BinaryTimeSeriesFile.create(filename, metrics, **create_kwargs)
+    try:
+        with f:
+            dt = _numpy_dtype(f)
+            for batch in batches:
+                f.append_raw(_encode_batch(batch, metrics, dt).tobytes())
+            return f.n_entries
+    except BaseException:
+        # don't leave an incomplete file (and its checksums) behind
+        for path in (filename, filename + BlockChecksums.SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+
+def from_arrow(
+    table,
+    filename: str,
+    time_column: str = None,
+    batch_size: int = 65536,
+    **kwargs,
+):
+    """
+    Write a pyarrow.Table into a new BinaryTimeSeriesFile and return the number
+    of entries written.
+
+    Columns written by to_arrow() keep their exact Metric definition, others
+    are mapped by their Arrow type (which has to be an integer, floating point
+    or bool type); unit and description are taken from the field metadata.
+
+    table: the pyarrow.Table to store
+    filename: the file to create
+    time_column: the name of the column to mark as is_time
+    batch_size: the number of rows converted at a time
+    further keyword arguments are passed on to BinaryTimeSeriesFile.create()
+    """
+    return _write_batches(
+        filename,
+        table.schema,
+        table.to_batches(max_chunksize=batch_size),
+        time_column,
+        kwargs,
+    )
+
+
+def from_parquet(
+    source,
+    filename: str,
+    columns: List[str] = None,
+    time_column: str = None,
+    batch_size: int = 65536,
+    **kwargs,
+):
+    """
+    Write (selected columns of) a Parquet file into a new BinaryTimeSeriesFile,
+    reading it batch by batch. See from_arrow() for the arguments.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pf = pq.ParquetFile(source)
+    schema = pf.schema_arrow
+    if columns is not None:
+        schema = pa.schema([schema.field(c) for c in columns], metadata=schema.metadata)
+    return _write_batches(
+        filename,
+        schema,
+        pf.iter_batches(batch_size=batch_size, columns=columns),
+        time_column,
+        kwargs,
+    )
+
+
+class _ResampleSource:
+    """
+    Streams the time and value columns of one file in chunks of chunk_rows
+    entries, so that the memory needed is bounded by the chunk size.
+    """
+
+    def __init__(self, f: BinaryTimeSeriesFile, t0, chunk_rows):
+        self.f = f
+        self.chunk_rows = chunk_rows
+        self.dtype = _numpy_dtype(f)
+        self.time_metric = next((m for m in f.metrics if m.is_time), f.metrics[0])
+        self.metrics = [
+            m for m in f.metrics if m is not self.time_metric and m.flags is None
+        ]
+        self.n_entries = f.n_entries
+        # start with the last sample before t0 (found by bisection)
+        self.pos = max(0, self._bisect(t0) - 1)
+        # the last sample processed (time, values) and the unprocessed rest
+        # of the last chunk read (times, values)
+        self.carry = None
+        self.pending = None
+
+    def _time_at(self, i):
+        raw = self._read(i, 1)[self.time_metric.identifier]
+        return float(_decode_column(self.time_metric, raw)[0])
+
+    def _bisect(self, t):
+        lo, hi = 0, self.n_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read(self, start, count):
+        import numpy as np
+
+        f = self.f
+        if f._verify:
+            f._verify_entries(start, start + count)
+        f._fd.seek(f._data_offset + start * f._struct_size)
+        return np.fromfile(f._fd, dtype=self.dtype, count=count)
+
+    def _next_chunk(self):
+        """ Return the (times, values) of the next chunk of samples or None """
+        import numpy as np
+
+        if self.pending is not None:
+            chunk, self.pending = self.pending, None
+            return chunk
+        if self.pos >= self.n_entries:
+            return None
+        count = min(self.chunk_rows, self.n_entries - self.pos)
+        raw = self._read(self.pos, count)
+        self.pos += count
+        times = _decode_column(self.time_metric, raw[self.time_metric.identifier])
+        values = np.empty((count, len(self.metrics)))
+        for j, m in enumerate(self.metrics):
+            values[:, j] = _decode_column(m, raw[m.identifier])
+        return times, values
+
+    def resample_block(self, grid, dt, how):
+        """
+        Return the values of the metrics at the (ascending) grid times, processing
+        the samples chunk by chunk. Only the last sample before the grid
+        (self.carry) and the part of the last chunk reaching beyond the grid
+        (self.pending) are kept for the next block.
+        """
+        import numpy as np
+
+        n_metrics = len(self.metrics)
+        out = np.full((len(grid), n_metrics), np.nan)
+        if how == "mean":
+            sums = np.zeros((len(grid), n_metrics))
+            counts = np.zeros(len(grid))
+            end, side = grid[-1] + dt, "left"
+        else:
+            end, side = grid[-1], "right"
+            if how == "last" and self.carry is not None:
+                out[:] = self.carry[1]
+
+        while True:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            times, values = chunk
+            split = int(times.searchsorted(end, side=side))
+            if split < len(times):
+                self.pending = times[split:], values[split:]
+            if how == "mean":
+                k = grid.searchsorted(times[:split], side="right") - 1
+                valid = (k >= 0) & (times[:split] < grid[k] + dt)
+                counts += np.bincount(k[valid], minlength=len(grid))
+                for j in range(n_metrics):
+                    sums[:, j] += np.bincount(
+                        k[valid], weights=values[:split][valid, j], minlength=len(grid)
+                    )
+            elif how == "last":
+                idx = times[:split].searchsorted(grid, side="right") - 1
+                valid = idx >= 0
+                out[valid] = values[idx[valid]]
+            elif how == "linear":
+                # interpolate from the carried sample up to the first sample
+                # beyond the grid (which stays pending for the next block)
+                t, v = times[: split + 1], values[: split + 1]
+                if self.carry is not None:
+                    t = np.concatenate([[self.carry[0]], t])
+                    v = np.concatenate([[self.carry[1]], v])
+                inside = (grid >= t[0]) & (grid <= t[-1])
+                for j in range(n_metrics):
+                    out[inside, j] = np.interp(grid[inside], t, v[:, j])
+            if split:
+                self.carry = times[split - 1], values[split - 1]
+            if self.pending is not None:
+                break
+
+        if how == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[:] = np.where(counts[:, np.newaxis] > 0, sums / counts[:, np.newaxis], np.nan)
+        return out
+
+
+def _open_sources(files, t0, chunk_rows):
+    """ Return the _ResampleSource of each file and the files opened here """
+    opened, sources = [], []
+    try:
+        for f in files:
+            if isinstance(f, str):
+                f = BinaryTimeSeriesFile.openread(f)
+                opened.append(f)
+            sources.append(_ResampleSource(f, t0, chunk_rows))
+    except BaseException:
+        for f in opened:
+            f.close()
+        raise
+    return sources, opened
+
+
+def _resampled_metrics(sources):
+    """ The metrics of the resampled data (named like the output fields) """
+    identifiers = [m.identifier for source in sources for m in source.metrics]
+    metrics = [Metric("time", MetricType.Double, is_time=True)]
+    for source in sources:
+        stem = os.path.splitext(os.path.basename(source.f._fdname))[0]
+        for m in source.metrics:
+            name = m.identifier
+            if identifiers.count(name) > 1:
+                name = f"{stem}.{name}"
+            metrics.append(
+                Metric(name, MetricType.Double, unit=m.unit, description=m.description)
+            )
+    return metrics
+
+
+def _resampled_blocks(sources, metrics, grid, how, block_size):
+    import numpy as np
+
+    if how not in ("last", "linear", "mean"):
+        raise ValueError(f"unknown resampling method: {how}")
+    t0, t1, dt = grid
+    if dt <= 0:
+        raise ValueError("dt must be positive")
+    dtype = np.dtype(
+        {"names": [m.identifier for m in metrics], "formats": ["f8"] * len(metrics)}
+    )
+    n_points = max(0, math.ceil((t1 - t0) / dt))
+    for first in range(0, n_points, block_size):
+        grid_times = t0 + dt * np.arange(first, min(first + block_size, n_points))
+        block = np.empty(len(grid_times), dtype=dtype)
+        block["time"] = grid_times
+        column = 1
+        for source in sources:
+            values = source.resample_block(grid_times, dt, how)
+            for j in range(values.shape[1]):
+                block[dtype.names[column + j]] = values[:, j]
+            column += values.shape[1]
+        yield block
+
+
+def resample(
+    files: Sequence[Union[BinaryTimeSeriesFile, str]],
+    grid: Tuple[float, float, float],
+    how: str = "last",
+    block_size: int = 65536,
+    chunk_rows: int = 65536,
+):
+    """
+    Resample the metrics of one or more files onto a common regular time grid,
+    streaming through the files. Generates structured numpy.arrays holding up to
+    block_size grid points each. The files are processed chunk by chunk, so the
+    memory needed is bounded by block_size and chunk_rows, whatever the length
+    of the range or the number of samples per grid point.
+
+    files: BinaryTimeSeriesFile instances or file names. The time of each file
+           is taken from its is_time metric (or its first metric) and has to be
+           ascending. Bit flag metrics are left out.
+    grid: (t0, t1, dt) - the grid times t0, t0 + dt, ... (< t1)
+    how: 'last'   - the last sample at or before the grid time (as-of join)
+         'linear' - linear interpolation between the neighbouring samples
+         'mean'   - the mean of the samples in [t, t + dt)
+         Grid points without data are NaN.
+    chunk_rows: number of entries read from a file at a time
+
+    The output fields are "time" and the metric identifiers (prefixed by the
+    file name, "<name>.<identifier>", where identifiers of several files collide).
+    """
+    sources, opened = _open_sources(files, grid[0], chunk_rows)
+    try:
+        metrics = _resampled_metrics(sources)
+        yield from _resampled_blocks(sources, metrics, grid, how, block_size)
+    finally:
+        for f in opened:
+            f.close()
+
+
+def resample_to_btsf(
+    filename: str,
+    files: Sequence[Union[BinaryTimeSeriesFile, str]],
+    grid: Tuple[float, float, float],
+    how: str = "last",
+    block_size: int = 65536,
+    chunk_rows: int = 65536,
+    **kwargs,
+):
+    """
+    Resample files like resample() does and store the result in a new
+    BinaryTimeSeriesFile of Double metrics (keeping units and descriptions).
+    Returns the number of entries written. Further keyword arguments are
+    passed on to BinaryTimeSeriesFile.create().
+    """
+    import numpy as np
+
+    sources, opened = _open_sources(files, grid[0], chunk_rows)
+    try:
+        metrics = _resampled_metrics(sources)
+        with BinaryTimeSeriesFile.create(filename, metrics, **kwargs) as f:
+            dt = _numpy_dtype(f)
+            for block in _resampled_blocks(sources, metrics, grid, how, block_size):
+                out = np.zeros(len(block), dtype=dt)
+                for name in block.dtype.names:
+                    out[name] = block[name]
+                f.append_raw(out.tobytes())
+            return f.n_entries
+    finally:
+        for f in opened:
+            f.close()
@@ -1,4 +1,4 @@
-from pytest import raises, approx as pytest_approx
+from pytest import raises, importorskip, approx as pytest_approx
 
 import math
 import tempfile
@@ -6,7 +6,7 @@ import io
 
 from btsf import BinaryTimeSeriesFile, Metric, MetricType
 from btsf import IntroSection, IntroSectionHeader, IntroSectionType
-from btsf import InvalidIntroSection
+from btsf import InvalidIntroSection, InvalidMetric
 
 
 def approx(*args, nan_ok=True, **kwargs):
@@ -255,3 +255,616 @@ def test_write_further_intro():
         # file was opened for reading only
         with raises(io.UnsupportedOperation):
             f.append(*VALID_TUPLES[0])
+
+
+COMPACT_METRICS = [
+    Metric("time", MetricType.Double, is_time=True),
+    Metric("adc", MetricType.Int16, unit="V", scale=0.001, offset=-1.0),
+    Metric("half", MetricType.Float16),
+    Metric("status", MetricType.UInt8, flags=["on", "error", "saturated"]),
+    Metric("valid", MetricType.Bool),
+]
+
+# fmt: off
+COMPACT_TUPLES = [
+    (0.0,  -1.0,   0.5,  (False, False, False), True),
+    (1.0,   0.25,  1.0,  (True,  False, True),  False),
+    (2.0,   2.5,  -2.0,  (True,  True,  False), True),
+]
+# fmt: on
+
+
+def test_compact_metric_types():
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, COMPACT_METRICS) as f:
+        assert f._struct_format == "<dheB?2x"
+        assert f._struct_size == 16
+        for t in COMPACT_TUPLES:
+            f.append(*t)
+        # flags can also be given as the raw bit mask
+        f.append(3.0, 0.0, 0.0, 0b011, False)
+        assert f.last()[3] == (True, True, False)
+
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f._metrics == COMPACT_METRICS
+        for t, values in zip(COMPACT_TUPLES, f):
+            assert t[:3] == approx(values[:3])
+            assert t[3:] == values[3:]
+        assert COMPACT_TUPLES[1][:3] == approx(f[1][:3])
+
+
+def test_compact_metric_types_to_numpy():
+    np = importorskip("numpy")
+    from btsf.util import to_numpy
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+    with BinaryTimeSeriesFile.create(tf.name, COMPACT_METRICS) as f:
+        for t in COMPACT_TUPLES:
+            f.append(*t)
+        a = to_numpy(f)
+        assert a["adc"] == approx([t[1] for t in COMPACT_TUPLES])
+        assert a["half"] == approx([t[2] for t in COMPACT_TUPLES])
+        assert a["status"].tolist() == [list(t[3]) for t in COMPACT_TUPLES]
+        assert a["valid"].dtype == np.bool_
+
+
+def test_compact_metric_types_to_pandas():
+    importorskip("pandas")
+    from btsf import BtsfError, BtsfNameError
+    from btsf.util import to_pandas
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+    with BinaryTimeSeriesFile.create(tf.name, COMPACT_METRICS) as f:
+        for t in COMPACT_TUPLES:
+            f.append(*t)
+        df = to_pandas(f)
+        assert list(df.columns) == [
+            "adc", "half", "status.on", "status.error", "status.saturated", "valid"
+        ]
+        assert list(df["status.saturated"]) == [t[3][2] for t in COMPACT_TUPLES]
+        with raises(BtsfNameError):
+            to_pandas(f, index_metric="status")
+
+
+def test_plain_metric_to_dict():
+    # no new keys for plain metrics, so that earlier versions can read the files
+    assert set(TYPICAL_METRICS[0].to_dict()) == {
+        "identifier", "type", "name", "unit", "description", "is_time"
+    }
+    assert COMPACT_METRICS[1].to_dict()["scale"] == 0.001
+    assert "flags" not in COMPACT_METRICS[1].to_dict()
+
+
+def test_invalid_compact_metrics():
+    with raises(InvalidMetric):
+        Metric("x", MetricType.Float, scale=0.1)
+    with raises(InvalidMetric):
+        Metric("x", MetricType.Int8, flags=["a"])
+    with raises(InvalidMetric):
+        Metric("x", MetricType.UInt8, flags=[str(i) for i in range(9)])
+
+
+def test_stats():
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS) as f:
+        # switched off by default
+        assert f.stats() == {}
+
+        events = []
+        f.enable_stats(hook=lambda stats, operation, seconds: events.append(operation))
+        for t in VALID_TUPLES:
+            f.append(*t)
+        stats = f.stats()
+        assert stats["bytes_written"] == len(VALID_TUPLES) * 24
+        assert stats["append_calls"] == len(VALID_TUPLES)
+        assert events == ["append"] * len(VALID_TUPLES)
+
+        assert len(list(f)) == len(VALID_TUPLES)
+        assert VALID_TUPLES[3] == approx(f[3])
+        stats = f.stats()
+        assert stats["rows_decoded"] == len(VALID_TUPLES) + 1
+        assert stats["bytes_read"] == (len(VALID_TUPLES) + 1) * 24
+        assert stats["getitem_calls"] == 1
+        assert stats["iter_seconds"] > 0
+        assert "btsf_bytes_read_total" in f._stats.to_prometheus()
+
+        f.disable_stats()
+        assert f.stats() == {}
+        assert VALID_TUPLES[-1] == approx(f.last())
+
+
+def test_server():
+    import json
+    import os
+    import struct
+    import threading
+    import urllib.request
+    from urllib.error import HTTPError
+    from btsf.server import make_server
+
+    metrics = [Metric("time", MetricType.Double, is_time=True), TYPICAL_METRICS[1]]
+    with tempfile.TemporaryDirectory() as directory:
+        with BinaryTimeSeriesFile.create(os.path.join(directory, "a.btsf"), metrics) as f:
+            for i in range(100):
+                f.append(i * 0.5, i)
+        with BinaryTimeSeriesFile.create(os.path.join(directory, "nan.btsf"), metrics) as f:
+            f.append(0.0, float("nan"))
+            f.append(1.0, float("-inf"))
+        # truncated within the intro sections
+        with open(os.path.join(directory, "a.btsf"), "rb") as fd:
+            truncated = fd.read(40)
+        with open(os.path.join(directory, "truncated.btsf"), "wb") as fd:
+            fd.write(truncated)
+        # a directory with a .btsf suffix
+        os.mkdir(os.path.join(directory, "sub.btsf"))
+        with BinaryTimeSeriesFile.create(
+            os.path.join(directory, "sub.btsf", "in.btsf"), metrics
+        ) as f:
+            f.append(0.0, 1.0)
+
+        server = make_server(directory, port=0, max_rows=50, quiet=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://%s:%d/" % server.server_address[:2]
+
+        def get(path):
+            with urllib.request.urlopen(base + path) as response:
+                return response.read()
+
+        try:
+            assert json.loads(get(""))["files"] == [
+                "a.btsf", "nan.btsf", "sub.btsf/in.btsf", "truncated.btsf"
+            ]
+            assert json.loads(get("a.btsf"))["n_entries"] == 100
+            assert json.loads(get("sub.btsf/in.btsf"))["n_entries"] == 1
+            assert json.loads(get("sub.btsf/in.btsf/rows"))["rows"] == [[0.0, 1.0]]
+
+            data = json.loads(get("a.btsf/rows?start=10&stop=13"))
+            assert data["rows"] == [[5.0, 10.0], [5.5, 11.0], [6.0, 12.0]]
+
+            data = json.loads(get("a.btsf/time?t0=10&t1=20&points=4"))
+            assert [row[0] for row in data["rows"]] == [10.0, 12.5, 15.0, 17.5]
+
+            raw = get("a.btsf/rows?start=-2&format=binary")
+            assert list(struct.iter_unpack("<df4x", raw)) == [(49.0, 98.0), (49.5, 99.0)]
+
+            with raises(HTTPError) as excinfo:
+                get("a.btsf/rows")
+            assert excinfo.value.code == 413
+            with raises(HTTPError) as excinfo:
+                get("../a.btsf")
+            assert excinfo.value.code == 404
+            with raises(HTTPError) as excinfo:
+                get("sub.btsf")
+            assert excinfo.value.code == 404
+            with raises(HTTPError) as excinfo:
+                get("a.btsf/columns")
+            assert excinfo.value.code == 404
+            with raises(HTTPError) as excinfo:
+                get("truncated.btsf")
+            assert excinfo.value.code == 415
+
+            # NaN and infinity are not valid JSON
+            body = get("nan.btsf/rows").decode("utf-8")
+            assert json.loads(body)["rows"] == [[0.0, None], [1.0, None]]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_preallocate():
+    import os
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, preallocate=4096) as f:
+        data_offset = f._data_offset
+        assert os.path.getsize(tf.name) == data_offset + 4096
+        assert f.n_entries == 0
+        for t in VALID_TUPLES:
+            f.append(*t)
+        assert f.n_entries == len(VALID_TUPLES)
+        assert VALID_TUPLES[-1] == approx(f.last())
+
+        # readers only see the committed entries, not the preallocated space
+        with BinaryTimeSeriesFile.openread(tf.name) as r:
+            assert r.n_entries == 0
+        f.flush()
+        with BinaryTimeSeriesFile.openread(tf.name) as r:
+            assert r.n_entries == len(VALID_TUPLES)
+            for i, values in enumerate(r):
+                assert VALID_TUPLES[i] == approx(values)
+            assert i == len(VALID_TUPLES) - 1
+            with raises(StopIteration):
+                next(r)
+
+        # grow beyond the first extent
+        for _ in range(200):
+            f.append(*VALID_TUPLES[0])
+        assert os.path.getsize(tf.name) == data_offset + 2 * 4096
+
+    # close() trims the file to the committed length
+    n_entries = len(VALID_TUPLES) + 200
+    assert os.path.getsize(tf.name) == data_offset + n_entries * 24
+
+    with BinaryTimeSeriesFile.openwrite(tf.name) as f:
+        assert f.n_entries == n_entries
+        f.append(*VALID_TUPLES[1])
+
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.n_entries == n_entries + 1
+        assert VALID_TUPLES[1] == approx(f.last())
+        assert len(list(f)) == n_entries + 1
+
+
+def test_arrow_round_trip():
+    pa = importorskip("pyarrow")
+    importorskip("pyarrow.parquet")
+    import os
+    from btsf import BtsfError, BtsfNameError
+    from btsf.util import to_arrow, from_arrow, to_parquet, from_parquet
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "compact.btsf")
+        with BinaryTimeSeriesFile.create(path, COMPACT_METRICS, byte_order=">") as f:
+            for t in COMPACT_TUPLES:
+                f.append(*t)
+
+        with BinaryTimeSeriesFile.openread(path) as f:
+            table = to_arrow(f)
+            assert table.column_names == [m.identifier for m in COMPACT_METRICS]
+            assert table.column("adc").to_pylist() == approx([t[1] for t in COMPACT_TUPLES])
+            assert table.schema.field("adc").metadata[b"unit"] == b"V"
+            assert table.column("status").to_pylist()[1] == {
+                "on": True, "error": False, "saturated": True
+            }
+            part = to_arrow(f, columns=["half", "time"], start=1, stop=-1)
+            assert part.to_pydict() == {"half": [1.0], "time": [1.0]}
+            to_parquet(f, os.path.join(directory, "compact.parquet"))
+
+        # files written from Arrow/Parquet keep the exact metric definitions
+        for n_entries in (
+            from_arrow(table, os.path.join(directory, "a.btsf"), batch_size=2),
+            from_parquet(
+                os.path.join(directory, "compact.parquet"), os.path.join(directory, "p.btsf")
+            ),
+        ):
+            assert n_entries == len(COMPACT_TUPLES)
+        for name in ("a.btsf", "p.btsf"):
+            with BinaryTimeSeriesFile.openread(os.path.join(directory, name)) as f:
+                assert f._metrics == COMPACT_METRICS
+                for t, values in zip(COMPACT_TUPLES, f):
+                    assert t[:3] == approx(values[:3])
+                    assert t[3:] == values[3:]
+
+        # time_column replaces the is_time metric of the metadata
+        path = os.path.join(directory, "t.btsf")
+        from_arrow(table, path, time_column="half")
+        with BinaryTimeSeriesFile.openread(path) as f:
+            assert [m.is_time for m in f.metrics] == [False, False, True, False, False]
+
+        # plain Arrow tables are mapped by their types
+        table = pa.table(
+            {"t": pa.array([0.0, 1.0]), "n": pa.array([1, 2], type=pa.int16())}
+        )
+        path = os.path.join(directory, "plain.btsf")
+        from_arrow(table, path, time_column="t")
+        with BinaryTimeSeriesFile.openread(path) as f:
+            assert [m.type for m in f.metrics] == [MetricType.Double, MetricType.Int16]
+            assert f.metrics[0].is_time
+            assert list(f) == [(0.0, 1), (1.0, 2)]
+
+        # nothing is written for an unknown time column
+        path = os.path.join(directory, "error.btsf")
+        table = pa.table({"t": pa.array([0.0, 1.0]), "s": pa.array(["a", "b"])})
+        with raises(BtsfNameError):
+            from_arrow(table, path, time_column="x")
+        # an incomplete file is removed (with its checksums) on errors
+        table = pa.table({"t": pa.array([0.0, None])})
+        with raises(BtsfError):
+            from_arrow(table, path, checksum_block=16)
+        assert not os.path.exists(path)
+        assert not os.path.exists(path + ".crc")
+
+
+def test_checksums():
+    import os
+    from btsf import ChecksumError
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, checksum_block=4) as f:
+        for t in VALID_TUPLES:
+            f.append(*t)
+        data_offset = f._data_offset
+    assert os.path.getsize(tf.name + ".crc") == 4 * 8
+
+    # continue appending, the checksum of the last incomplete block is resumed
+    with BinaryTimeSeriesFile.openwrite(tf.name) as f:
+        f.append(*VALID_TUPLES[0])
+        assert f.verify_checksums() == []
+    n_entries = len(VALID_TUPLES) + 1
+
+    with BinaryTimeSeriesFile.openread(tf.name, verify=True) as f:
+        assert len(list(f)) == n_entries
+        assert VALID_TUPLES[5] == approx(f[5])
+
+    # corrupt a byte of entry 9 (in the 3rd block)
+    with open(tf.name, "r+b") as fd:
+        fd.seek(data_offset + 9 * 24 + 3)
+        fd.write(b"\xff")
+
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.verify_checksums(workers=2) == [range(8, 12)]
+        # without verification the corruption goes unnoticed
+        assert len(list(f)) == n_entries
+
+    with BinaryTimeSeriesFile.openread(tf.name, verify=True) as f:
+        assert VALID_TUPLES[5] == approx(f[5])
+        with raises(ChecksumError):
+            f[9]
+        with raises(ChecksumError):
+            list(f)
+    os.remove(tf.name + ".crc")
+
+
+def test_resample():
+    np = importorskip("numpy")
+    import os
+    from btsf.util import resample, resample_to_btsf
+
+    with tempfile.TemporaryDirectory() as directory:
+        fast = os.path.join(directory, "fast.btsf")
+        slow = os.path.join(directory, "slow.btsf")
+        metrics = [Metric("t", MetricType.Double, is_time=True), Metric("v", MetricType.Float)]
+        # v == t in both files, sampled every 0.1 and every 1.5 time units
+        with BinaryTimeSeriesFile.create(fast, metrics) as f:
+            for i in range(1000):
+                f.append(i * 0.1, i * 0.1)
+        with BinaryTimeSeriesFile.create(slow, metrics) as f:
+            for i in range(40):
+                f.append(i * 1.5, i * 1.5)
+
+        grid = (10.0, 50.0, 1.0)
+        expected_time = np.arange(10.0, 50.0, 1.0)
+
+        blocks = list(resample([fast, slow], grid, how="last", block_size=7, chunk_rows=16))
+        assert len(blocks) == 6
+        a = np.concatenate(blocks)
+        assert a.dtype.names == ("time", "fast.v", "slow.v")
+        assert a["time"] == approx(expected_time)
+        assert a["fast.v"] == approx(expected_time, abs=1e-5)
+        assert a["slow.v"] == approx(np.floor(expected_time / 1.5) * 1.5)
+
+        a = np.concatenate(list(resample([fast, slow], grid, how="linear", block_size=7)))
+        assert a["slow.v"] == approx(expected_time)
+
+        a = np.concatenate(list(resample([fast], grid, how="mean", chunk_rows=10)))
+        assert a["v"] == approx(expected_time + 0.45, abs=1e-5)
+
+        # beyond the recorded data
+        a = np.concatenate(list(resample([slow], (60.0, 65.0, 1.0), how="linear")))
+        assert np.isnan(a["v"]).all()
+
+        out = os.path.join(directory, "resampled.btsf")
+        assert resample_to_btsf(out, [fast, slow], grid) == len(expected_time)
+        with BinaryTimeSeriesFile.openread(out) as f:
+            assert [m.identifier for m in f.metrics] == ["time", "fast.v", "slow.v"]
+            assert f.metrics[0].is_time
+            assert f[3] == approx((13.0, 13.0, 12.0), abs=1e-5)
+
+
+def test_preallocate_next_reads_committed_length_once():
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, preallocate=4096) as f:
+        for t in VALID_TUPLES:
+            f.append(*t)
+        f.flush()
+
+        with BinaryTimeSeriesFile.openread(tf.name) as r:
+            r.goto_entry(0)
+            reads = []
+            read_committed = r._read_committed
+            r._read_committed = lambda: reads.append(1) or read_committed()
+            for t in VALID_TUPLES:
+                assert t == approx(next(r))
+            # the committed length was read once, not for every entry
+            assert len(reads) == 1
+
+            # at the end, newly committed entries are picked up
+            with raises(StopIteration):
+                next(r)
+            f.append(*VALID_TUPLES[0])
+            f.flush()
+            assert VALID_TUPLES[0] == approx(next(r))
+            f.append(*VALID_TUPLES[1])
+            f.flush()
+            assert len(list(r)) == len(VALID_TUPLES) + 2
+            assert VALID_TUPLES[1] == approx(r.last())
+
+
+def test_preallocate_disable_stats():
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, preallocate=4096) as f:
+        f.enable_stats()
+        f.append(*VALID_TUPLES[0])
+        f.disable_stats()
+        for t in VALID_TUPLES[1:10]:
+            f.append(*t)
+        assert f.n_entries == 10
+
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.n_entries == 10
+        for i, values in enumerate(f):
+            assert VALID_TUPLES[i] == approx(values)
+
+
+def test_checksums_disable_stats():
+    import os
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, checksum_block=4) as f:
+        f.enable_stats()
+        f.append(*VALID_TUPLES[0])
+        f.disable_stats()
+        for t in VALID_TUPLES[1:10]:
+            f.append(*t)
+
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.verify_checksums() == []
+        assert f._checksums is None
+    assert os.path.getsize(tf.name + ".crc") == 3 * 8
+    os.remove(tf.name + ".crc")
+
+
+def test_verify_reports_entries_without_checksum():
+    import argparse
+    import os
+    from btsf import cli
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, checksum_block=4) as f:
+        for t in VALID_TUPLES[:10]:
+            f.append(*t)
+    args = argparse.Namespace(btsf_file=tf.name, jobs=None)
+    cli.verify(args)
+
+    # lose the record of the last (incomplete) block, as after a crash
+    with open(tf.name + ".crc", "r+b") as fd:
+        fd.truncate(2 * 8)
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.verify_checksums() == []
+        assert f.entries_without_checksum() == [range(8, 10)]
+    with raises(SystemExit) as excinfo:
+        cli.verify(args)
+    assert excinfo.value.code == 2
+
+    with open(tf.name + ".crc", "r+b") as fd:
+        fd.truncate(0)
+    with BinaryTimeSeriesFile.openread(tf.name) as f:
+        assert f.entries_without_checksum() == [range(0, 10)]
+    os.remove(tf.name + ".crc")
+
+
+def test_checksums_resume_after_crash():
+    import os
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, checksum_block=4) as f:
+        for t in VALID_TUPLES[:10]:
+            f.append(*t)
+        # completed blocks reach the sidecar right away
+        assert os.path.getsize(tf.name + ".crc") == 2 * 8
+
+    # all records lost, as after a crash of the writer
+    with open(tf.name + ".crc", "r+b") as fd:
+        fd.truncate(0)
+
+    with BinaryTimeSeriesFile.openwrite(tf.name) as f:
+        for t in VALID_TUPLES[10:]:
+            f.append(*t)
+
+    with BinaryTimeSeriesFile.openread(tf.name, verify=True) as f:
+        assert f.verify_checksums() == []
+        assert f.entries_without_checksum() == [range(0, 8)]
+        assert len(list(f)) == len(VALID_TUPLES)
+    os.remove(tf.name + ".crc")
+
+
+def test_resample_coarse_grid_in_chunks():
+    np = importorskip("numpy")
+    from btsf.util import _ResampleSource
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+    metrics = [Metric("t", MetricType.Double, is_time=True), Metric("v", MetricType.Double)]
+    with BinaryTimeSeriesFile.create(tf.name, metrics) as f:
+        for i in range(1000):
+            f.append(i * 0.1, i * 0.1)
+
+        # every grid block spans many chunks, only a single chunk is kept
+        grid = np.arange(0.0, 100.0, 30.0)
+        for how, expected in (
+            ("last", grid),
+            ("linear", grid),
+            ("mean", [14.95, 44.95, 74.95, 94.95]),
+        ):
+            source = _ResampleSource(f, 0.0, chunk_rows=8)
+            values = []
+            for first in range(len(grid)):
+                values.extend(source.resample_block(grid[first : first + 1], 30.0, how)[:, 0])
+                assert source.pending is None or len(source.pending[0]) <= 8
+            assert values == approx(expected)
+
+
+def test_checksums_preallocate_resume_after_crash():
+    import os
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    f = BinaryTimeSeriesFile.create(
+        tf.name, TYPICAL_METRICS, preallocate=4096, checksum_block=4
+    )
+    for t in VALID_TUPLES[:4]:
+        f.append(*t)
+    f.flush()
+    # checksums of entries never committed reach the sidecar, then the writer crashes
+    for _ in range(2):
+        for t in VALID_TUPLES:
+            f.append(*t)
+    f._fd.flush()
+    f._checksums.flush()
+
+    with BinaryTimeSeriesFile.openread(tf.name) as r:
+        assert r.n_entries == 4
+        assert r.verify_checksums() == []
+
+    with BinaryTimeSeriesFile.openwrite(tf.name) as w:
+        assert w.n_entries == 4
+        # stale records are removed
+        assert os.path.getsize(tf.name + ".crc") == 8
+        w.append(*VALID_TUPLES[4])
+        w.append(*VALID_TUPLES[5])
+
+    with BinaryTimeSeriesFile.openread(tf.name, verify=True) as r:
+        assert r.n_entries == 6
+        assert r.verify_checksums() == []
+        assert r.entries_without_checksum() == []
+        for i, values in enumerate(r):
+            assert VALID_TUPLES[i] == approx(values)
+    f._checksums.close()
+    f._fd.close()
+    os.remove(tf.name + ".crc")
+
+
+def test_checksums_partial_block_verified_once():
+    import os
+
+    tf = tempfile.NamedTemporaryFile(suffix=".btsf")
+
+    with BinaryTimeSeriesFile.create(tf.name, TYPICAL_METRICS, checksum_block=64) as f:
+        for t in VALID_TUPLES:
+            f.append(*t)
+        f.flush()
+
+        with BinaryTimeSeriesFile.openread(tf.name, verify=True) as r:
+            verified_blocks = []
+            verify_blocks = r._checksums.verify_blocks
+            r._checksums.verify_blocks = lambda *args: (
+                verified_blocks.append(args[0]) or verify_blocks(*args)
+            )
+            for i in range(len(VALID_TUPLES)):
+                assert VALID_TUPLES[i] == approx(r[i])
+            assert verified_blocks == [[0]]
+
+            # the partial block is verified again once its checksum covers more
+            f.append(*VALID_TUPLES[0])
+            f.flush()
+            assert VALID_TUPLES[0] == approx(r.last())
+            assert verified_blocks == [[0], [0]]
+    os.remove(tf.name + ".crc")